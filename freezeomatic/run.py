@@ -1,25 +1,40 @@
 from __future__ import annotations
+import contextlib
 import csv
+import functools
+import gzip
+import io
 import os
+import queue
+import stat
 import subprocess
 import tarfile
+import threading
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, replace
 from enum import Enum
 from tempfile import gettempdir
-from typing import List
+from typing import (IO, Any, Callable, Dict, List, Optional, Tuple,
+                    Union)
 
 import boto3
 import botocore
 import boto3.s3.transfer as s3transfer
 import tqdm
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 from freezeomatic.utils import get_logger
 
 logger = get_logger(__name__)
 
-CONNECTIONS = 15
+CONNECTIONS = int(os.getenv('CONNECTIONS', '15'))
+# One of crt, classic or auto (see boto3's TransferConfig)
+TRANSFER_CLIENT = os.getenv('TRANSFER_CLIENT', 'auto')
+MB = 1024 * 1024
+TAR_BUFFER_SIZE = 2 * MB
+LOCK_BACKUP_PREFIX = '.freezeomatic/'
+PARTIAL_UPLOAD_PREFIX = '.freezeomatic/partial/'
 
 
 class StorageClass(Enum):
@@ -35,8 +50,10 @@ class StorageClass(Enum):
 
 DEFAULT_STORAGE = StorageClass.DEEP_ARCHIVE
 
+_STORAGE_CLASSES = {m.value: m for m in StorageClass}
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class FreezerEntry:
     source_path: str
     target_path: str
@@ -44,23 +61,29 @@ class FreezerEntry:
     force: bool
 
 
-class LockStatus(Enum):
+# The str mixin makes hashing and comparing statuses plain str operations
+class LockStatus(str, Enum):
     PENDING = '00-pending'
     FREEZING = '10-freezing'
     FROZEN = '20-frozen'
     DEPRECATED = '90-deprecated'
 
 
-UPLOADED_STATUSES = {LockStatus.FROZEN, LockStatus.DEPRECATED}
+UPLOADED_STATUSES = frozenset({LockStatus.FROZEN, LockStatus.DEPRECATED})
+
+_LOCK_STATUSES = {m.value: m for m in LockStatus}
 
 
-@dataclass
+@dataclass(slots=True)
 class FreezerLockEntry:
     target_path: str
     source_path: str
     storage_class: StorageClass
     status: LockStatus
     force: bool
+    # Source file size and mtime when it was last packed for upload
+    size: Optional[int] = None
+    mtime_ns: Optional[int] = None
 
     def deprecate(self) -> FreezerLockEntry:
         return replace(self, status=LockStatus.DEPRECATED)
@@ -68,59 +91,99 @@ class FreezerLockEntry:
     def requires_upload(self) -> bool:
         return self.status not in UPLOADED_STATUSES or self.force
 
+    def is_unchanged(self, source_stat: os.stat_result) -> bool:
+        return self.status in UPLOADED_STATUSES \
+            and stat.S_ISREG(source_stat.st_mode) \
+            and self.mtime_ns is not None \
+            and (source_stat.st_size, source_stat.st_mtime_ns) \
+            == (self.size, self.mtime_ns)
+
+
+# Entry, local file to upload (None when streamed) and its size if known
+PendingEntry = Tuple[FreezerLockEntry, Optional[os.stat_result]]
+PackedEntry = Tuple[FreezerLockEntry, Optional[str], Optional[int]]
+UploadResult = Tuple[FreezerLockEntry, Union[bool, Exception]]
+
 
 def freeze(bucket: str, freezer_path: str, python_tar: bool,
            tmp_dir: str) -> int:
-    freezer_entries = _read_freezer(freezer_path)
     lock_path = f'{freezer_path}.lock'
-    freezer_lock_entries = _read_lock(lock_path)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # Warms up the cached client while the CSVs are parsed
+        executor.submit(_s3_client)
+        freezer_future = executor.submit(_read_freezer, freezer_path)
+        lock_future = executor.submit(_read_lock, lock_path)
+        freezer_entries = freezer_future.result()
+        freezer_lock_entries = lock_future.result()
 
     updated_lock_entries = _update_lock_entries(freezer_entries,
                                                 freezer_lock_entries)
-    _upload(lock_path, updated_lock_entries, bucket, python_tar, tmp_dir)
+    _upload(freezer_path, lock_path, updated_lock_entries, bucket, python_tar,
+            tmp_dir)
 
     return 0
 
 
 def _read_freezer(path: str) -> List[FreezerEntry]:
-    freezer = []
     with open(path, newline='') as freezer_file:
         reader = csv.reader(freezer_file, delimiter=',')
-        for row in reader:
-            freezer.append(FreezerEntry(
-                source_path=row[0],
-                target_path=row[1],
-                storage_class=StorageClass(row[2])
-                if row[2] != '' else DEFAULT_STORAGE,
-                force=row[3] == 'force'
-            ))
-    return freezer
+        return [FreezerEntry(
+            source_path=row[0],
+            target_path=row[1],
+            storage_class=_STORAGE_CLASSES[row[2]]
+            if row[2] != '' else DEFAULT_STORAGE,
+            force=row[3] == 'force'
+        ) for row in reader]
 
 
 def _read_lock(lock_path: str) -> List[FreezerLockEntry]:
-    lock = []
+    lock = {}
     if os.path.isfile(lock_path):
         with open(lock_path) as lock_file:
             reader = csv.reader(lock_file, delimiter=',')
-            for row in reader:
-                lock.append(
-                    FreezerLockEntry(
-                        target_path=row[0],
-                        source_path=row[1],
-                        storage_class=StorageClass(row[2]),
-                        status=LockStatus(row[3]),
-                        force=row[4] == 'force'
-                    ))
-    return lock
+            lock = {row[0]: _lock_entry(row) for row in reader}
+    journal_path = f'{lock_path}.wal'
+    if os.path.isfile(journal_path):
+        logger.info(f'Recovering interrupted run from {journal_path}')
+        _replay_journal(journal_path, lock)
+    return list(lock.values())
+
+
+def _replay_journal(journal_path: str,
+                    lock: Dict[str, FreezerLockEntry]) -> None:
+    with open(journal_path) as journal_file:
+        for row in csv.reader(journal_file, delimiter=','):
+            try:
+                lock[row[0]] = _lock_entry(row)
+            except (IndexError, KeyError, ValueError):
+                # Torn last line from the interrupted run
+                logger.warning(f'Ignoring journal line {row}')
+
+
+def _lock_entry(row: List[str]) -> FreezerLockEntry:
+    return FreezerLockEntry(
+        target_path=row[0],
+        source_path=row[1],
+        storage_class=_STORAGE_CLASSES[row[2]],
+        status=_LOCK_STATUSES[row[3]],
+        force=row[4] == 'force',
+        size=_optional_int(row, 5),
+        mtime_ns=_optional_int(row, 6))
+
+
+def _optional_int(row: List[str], index: int) -> Optional[int]:
+    return int(row[index]) if len(row) > index and row[index] else None
 
 
 def _update_lock_entries(freezer_entries: List[FreezerEntry],
                          lock_entries: List[FreezerLockEntry]) \
         -> List[FreezerLockEntry]:
+    lock_by_target = {le.target_path: le for le in lock_entries}
+    freezer_targets = {fe.target_path for fe in freezer_entries}
+
     updated = []
     for freezer_entry in freezer_entries:
-        lock_entry = next((le for le in lock_entries if
-                           le.target_path == freezer_entry.target_path), None)
+        lock_entry = lock_by_target.get(freezer_entry.target_path)
         if not lock_entry:
             lock_entry = FreezerLockEntry(
                 freezer_entry.target_path,
@@ -130,54 +193,224 @@ def _update_lock_entries(freezer_entries: List[FreezerEntry],
                 freezer_entry.force)
         updated.append(lock_entry)
 
-    for lock_entry in lock_entries:
-        entry = next((fe for fe in freezer_entries if
-                      fe.target_path == lock_entry.target_path), None)
-        if not entry:
-            updated.append(lock_entry.deprecate())
+    updated.extend(le.deprecate() for le in lock_entries
+                   if le.target_path not in freezer_targets)
 
     return updated
 
 
-def _upload(lock_path: str, lock_entries: List[FreezerLockEntry],
+def _upload(freezer_path: str, lock_path: str,
+            lock_entries: List[FreezerLockEntry],
             bucket: str, python_tar: bool, tmp_dir: str) -> None:
-    _dump_lock(lock_path, lock_entries)
-    pending = [e for e in lock_entries if e.requires_upload()]
-    for entry in pending:
+    pending: List[PendingEntry] = []
+    for entry in lock_entries:
+        if entry.requires_upload():
+            source_stat = _stat(entry.source_path)
+            if not _is_unchanged(entry, source_stat):
+                pending.append((entry, source_stat))
+    if not pending:
+        _commit_lock(lock_path, lock_entries)
+        return
+    pending.sort(key=_upload_order)
+
+    for entry, _ in pending:
         entry.status = LockStatus.FREEZING
-        _dump_lock(lock_path, lock_entries)
-        if _upload_entry(entry, bucket, python_tar, tmp_dir):
-            entry.status = LockStatus.FROZEN
-        _dump_lock(lock_path, lock_entries)
+
+    # The freezer and lock files go last, once the lock reflects this run.
+    # They're stat'ed again when packed, as the lock is written just before.
+    own_paths = {os.path.abspath(freezer_path), os.path.abspath(lock_path)}
+    last: List[PendingEntry] = [
+        (e, None) for e, _ in pending
+        if os.path.abspath(e.source_path) in own_paths]
+    first = [(e, s) for e, s in pending
+             if os.path.abspath(e.source_path) not in own_paths]
+
+    lock_key = f'{LOCK_BACKUP_PREFIX}{os.path.basename(lock_path)}'
+    # Sizes are added to the total as they become known
+    progress = tqdm.tqdm(
+        desc='upload',
+        total=0, unit='B', unit_scale=1,
+        bar_format='{desc:<10}{percentage:3.0f}%|{bar:10}{r_bar}')
+    with open(f'{lock_path}.wal', 'a', newline='') as journal, \
+            _transfer_manager() as s3t, \
+            _LockBackup(bucket, lock_key, lock_entries) as lock_backup:
+        try:
+            _upload_batch(s3t, progress, journal, lock_backup, first, bucket,
+                          python_tar, tmp_dir)
+            if last:
+                _dump_lock(lock_path, lock_entries)
+                _upload_batch(s3t, progress, journal, lock_backup, last,
+                              bucket, python_tar, tmp_dir)
+        finally:
+            progress.close()
+            _commit_lock(lock_path, lock_entries)
+
+
+def _upload_batch(s3t: Any, progress: tqdm.tqdm, journal: IO[str],
+                  lock_backup: _LockBackup, batch: List[PendingEntry],
+                  bucket: str, python_tar: bool, tmp_dir: str) -> None:
+    if not batch:
+        return
+    packed: queue.Queue[Optional[PackedEntry]] = queue.Queue(maxsize=2)
+    # pigz already uses every core, so archives are streamed one at a time,
+    # by a worker of their own
+    streamed: queue.Queue[Optional[PackedEntry]] = queue.Queue()
+    uploaded: queue.Queue[UploadResult] = queue.Queue()
+    stop = threading.Event()
+    packer = threading.Thread(
+        target=_pack_pending,
+        args=(batch, python_tar, tmp_dir, packed, streamed, uploaded, stop,
+              CONNECTIONS),
+        daemon=True)
+    with ThreadPoolExecutor(max_workers=CONNECTIONS + 1) as executor:
+        packer.start()
+        for _ in range(CONNECTIONS):
+            executor.submit(_upload_packed, s3t, progress, bucket, packed,
+                            uploaded, stop)
+        executor.submit(_upload_packed, s3t, progress, bucket, streamed,
+                        uploaded, stop)
+        try:
+            for _ in batch:
+                entry, result = uploaded.get()
+                if isinstance(result, Exception):
+                    raise result
+                if result:
+                    _freeze_entry(entry, journal)
+                lock_backup.mark_dirty()
+        except BaseException:
+            stop.set()
+            s3t.shutdown(cancel=True)
+            executor.shutdown(cancel_futures=True)
+            # Uploads that finished while stopping are still recorded
+            while not uploaded.empty():
+                entry, result = uploaded.get_nowait()
+                if result is True:
+                    _freeze_entry(entry, journal)
+            raise
+
+
+def _freeze_entry(entry: FreezerLockEntry, journal: IO[str]) -> None:
+    entry.status = LockStatus.FROZEN
+    csv.writer(journal, delimiter=',').writerow(_lock_row(entry))
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def _stat(path: str) -> Optional[os.stat_result]:
+    # Missing sources fail when they're packed
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _is_unchanged(entry: FreezerLockEntry,
+                  source_stat: Optional[os.stat_result]) -> bool:
+    if entry.mtime_ns is None or source_stat is None:
+        return False
+    if entry.is_unchanged(source_stat):
+        logger.debug(f'Not uploading unchanged {entry.source_path}')
+        return True
+    return False
 
 
-def _upload_entry(entry: FreezerLockEntry, bucket: str,
-                  python_tar: bool, tmp_dir: str) -> bool:
+def _upload_order(pending_entry: PendingEntry) -> Tuple[bool, int]:
+    # Directories first, in freezer order, as packing them takes longest.
+    # Then files, biggest first, so that small ones fill the gaps at the end.
+    source_stat = pending_entry[1]
+    if source_stat is None:
+        return True, 0
+    if stat.S_ISDIR(source_stat.st_mode):
+        return False, 0
+    return True, -source_stat.st_size
+
+
+def _pack_pending(pending: List[PendingEntry], python_tar: bool,
+                  tmp_dir: str, packed: queue.Queue[Optional[PackedEntry]],
+                  streamed: queue.Queue[Optional[PackedEntry]],
+                  uploaded: queue.Queue[UploadResult], stop: threading.Event,
+                  consumers: int) -> None:
+    try:
+        for entry, source_stat in pending:
+            if stop.is_set():
+                break
+            try:
+                local_file, size = _pack_entry(entry, source_stat,
+                                               python_tar, tmp_dir)
+            except Exception as e:
+                uploaded.put((entry, e))
+                continue
+            if local_file is None:
+                streamed.put((entry, local_file, size))
+            else:
+                packed.put((entry, local_file, size))
+    finally:
+        for _ in range(consumers):
+            packed.put(None)
+        streamed.put(None)
+
+
+def _upload_packed(s3t: Any, progress: tqdm.tqdm, bucket: str,
+                   packed: queue.Queue[Optional[PackedEntry]],
+                   uploaded: queue.Queue[UploadResult],
+                   stop: threading.Event) -> None:
+    while True:
+        item = packed.get()
+        if item is None:
+            return
+        if stop.is_set():
+            # Keep draining so that the packer isn't blocked on a full queue
+            continue
+        entry, local_file, size = item
+        try:
+            uploaded.put((entry, _upload_entry(s3t, progress, entry, bucket,
+                                               local_file, size)))
+        except Exception as e:
+            uploaded.put((entry, e))
+
+
+def _pack_entry(entry: FreezerLockEntry,
+                source_stat: Optional[os.stat_result], python_tar: bool,
+                tmp_dir: str) -> Tuple[Optional[str], Optional[int]]:
     source_path = entry.source_path
     target_path = entry.target_path
-    storage_class = entry.storage_class
-    if os.path.isfile(source_path):
-        _upload_file(source_path, bucket, target_path, storage_class)
-        return True
-    elif os.path.isdir(source_path):
-        if target_path.endswith('tar.gz'):
-            local_file = _compress_tgz(entry, python_tar, tmp_dir)
-        elif target_path.endswith('tar'):
-            local_file = _pack_tar(entry, python_tar, tmp_dir)
-        else:
+    if source_stat is None:
+        source_stat = os.stat(source_path)
+    if stat.S_ISREG(source_stat.st_mode):
+        entry.size = source_stat.st_size
+        entry.mtime_ns = source_stat.st_mtime_ns
+        return source_path, source_stat.st_size
+    elif stat.S_ISDIR(source_stat.st_mode):
+        extension = next((e for e in _PACKERS if target_path.endswith(e)),
+                         None)
+        if extension is None:
             raise ValueError(f'Unknown extension for dir: {target_path}')
-
-        if _upload_file(local_file, bucket, target_path, storage_class):
-            logger.debug(f'Upload finished for {local_file} (delete manually)')
-            # TODO:
-            # os.remove(local_tgz)
-            return True
+        packer = _PACKERS[extension]
+        if packer is _compress_tgz and not python_tar:
+            # Streamed straight into S3 by _upload_entry
+            return None, None
+        return packer(entry, python_tar, tmp_dir), None
     else:
         raise ValueError(f'Unsupported entry upload: {entry}')
-    return False
 
 
-def _compress_tgz(entry: FreezerLockEntry, python_tar: bool, tmp_dir: str):
+def _upload_entry(s3t: Any, progress: tqdm.tqdm, entry: FreezerLockEntry,
+                  bucket: str, local_file: Optional[str],
+                  size: Optional[int]) -> bool:
+    if local_file is None:
+        return _stream_tgz(s3t, progress, entry, bucket)
+    if not _upload_file(s3t, progress, local_file, bucket, entry.target_path,
+                        entry.storage_class, size):
+        return False
+    if local_file != entry.source_path:
+        logger.debug(f'Upload finished for {local_file} (delete manually)')
+        # TODO:
+        # os.remove(local_file)
+    return True
+
+
+def _compress_tgz(entry: FreezerLockEntry, python_tar: bool,
+                  tmp_dir: str) -> str:
     source_path = entry.source_path
     local_tgz = os.path.join(tmp_dir,
                              f'{os.path.basename(source_path)}.tar.gz')
@@ -186,17 +419,43 @@ def _compress_tgz(entry: FreezerLockEntry, python_tar: bool, tmp_dir: str):
                      f'existing {local_tgz}...')
     else:
         logger.debug(f'Compressing {source_path} into {local_tgz}...')
-        if python_tar:
-            with tarfile.open(local_tgz, 'w|gz') as tar:
-                tar.add(source_path, arcname=os.path.basename(source_path))
-        else:
-            subprocess.run(
-                [f'sudo tar --use-compress-program=pigz -cf "{local_tgz}" *'],
-                check=True, cwd=source_path, shell=True)
+        with gzip.open(local_tgz, 'wb', compresslevel=6) as gz, \
+                tarfile.TarFile(mode='w', fileobj=gz,
+                                copybufsize=TAR_BUFFER_SIZE) as tar:
+            tar.add(source_path, arcname=os.path.basename(source_path))
     return local_tgz
 
 
-def _pack_tar(entry: FreezerLockEntry, python_tar: bool, tmp_dir: str):
+def _stream_tgz(s3t: Any, progress: tqdm.tqdm, entry: FreezerLockEntry,
+                bucket: str) -> bool:
+    source_path = entry.source_path
+    target_path = entry.target_path
+    # The archive only replaces the target once tar has succeeded
+    partial_path = f'{PARTIAL_UPLOAD_PREFIX}{target_path}'
+    logger.debug(f'Streaming {source_path} to {partial_path}...')
+    tar = subprocess.Popen(
+        ['sudo tar --use-compress-program=pigz -cf - *'],
+        cwd=source_path, shell=True, stdout=subprocess.PIPE, bufsize=MB)
+    assert tar.stdout is not None
+    try:
+        uploaded = _transfer(s3t, progress, tar.stdout, bucket,
+                             partial_path, StorageClass.STANDARD, None)
+    finally:
+        tar.stdout.close()
+        return_code = tar.wait()
+    try:
+        if uploaded and return_code != 0:
+            raise subprocess.CalledProcessError(return_code, tar.args)
+        if uploaded:
+            uploaded = _copy(bucket, partial_path, target_path,
+                             entry.storage_class)
+    finally:
+        _s3_client().delete_object(Bucket=bucket, Key=partial_path)
+    return uploaded
+
+
+def _pack_tar(entry: FreezerLockEntry, python_tar: bool,
+              tmp_dir: str) -> str:
     source_path = entry.source_path
     local_tar = os.path.join(tmp_dir, f'{os.path.basename(source_path)}.tar')
     if os.path.isfile(local_tar):
@@ -205,7 +464,8 @@ def _pack_tar(entry: FreezerLockEntry, python_tar: bool, tmp_dir: str):
     else:
         logger.debug(f'Packing {source_path} into {local_tar}...')
         if python_tar:
-            with tarfile.open(local_tar, 'w') as tar:
+            with tarfile.TarFile(local_tar, 'w',
+                                 copybufsize=TAR_BUFFER_SIZE) as tar:
                 tar.add(source_path, arcname=os.path.basename(source_path))
         else:
             subprocess.run([f'tar -cf "{local_tar}" *'],
@@ -213,48 +473,170 @@ def _pack_tar(entry: FreezerLockEntry, python_tar: bool, tmp_dir: str):
     return local_tar
 
 
-def _upload_file(source_path: str, bucket: str,
-                 target_path: str, storage_class: StorageClass) -> bool:
-    logger.debug(f'Uploading {source_path} to {target_path}...')
-    botocore_config = botocore.config.Config(max_pool_connections=CONNECTIONS)
-    s3 = boto3.client('s3', config=botocore_config)
+_PACKERS: Dict[str, Callable[[FreezerLockEntry, bool, str], str]] = {
+    '.tar.gz': _compress_tgz,
+    '.tgz': _compress_tgz,
+    '.tar': _pack_tar,
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _s3_client() -> Any:
+    botocore_config = botocore.config.Config(
+        max_pool_connections=CONNECTIONS * 4,
+        retries={'max_attempts': 10, 'mode': 'adaptive'})
+    return boto3.session.Session().client('s3', config=botocore_config)
+
+
+def _transfer_manager() -> Any:
+    # Falls back to the classic manager if the CRT one can't be created
     transfer_config = s3transfer.TransferConfig(
-        use_threads=True,
+        multipart_threshold=8 * MB,
+        multipart_chunksize=64 * MB,
         max_concurrency=CONNECTIONS,
+        preferred_transfer_client=TRANSFER_CLIENT,
     )
-    s3t = s3transfer.create_transfer_manager(s3, transfer_config)
-    total_size = os.path.getsize(source_path)
-    progress = tqdm.tqdm(
-        desc='upload',
-        total=total_size, unit='B', unit_scale=1,
-        position=0,
-        bar_format='{desc:<10}{percentage:3.0f}%|{bar:10}{r_bar}')
-    future = s3t.upload(source_path, bucket, target_path,
+    return s3transfer.create_transfer_manager(_s3_client(), transfer_config)
+
+
+def _upload_file(s3t: Any, progress: tqdm.tqdm, source_path: str,
+                 bucket: str, target_path: str, storage_class: StorageClass,
+                 total_size: Optional[int] = None) -> bool:
+    logger.debug(f'Uploading {source_path} to {target_path}...')
+    if total_size is None:
+        total_size = os.path.getsize(source_path)
+    return _transfer(s3t, progress, source_path, bucket, target_path,
+                     storage_class, total_size)
+
+
+def _transfer(s3t: Any, progress: tqdm.tqdm,
+              source: Union[str, IO[bytes]], bucket: str,
+              target_path: str, storage_class: StorageClass,
+              total_size: Optional[int]) -> bool:
+    if total_size is not None:
+        with progress.get_lock():
+            progress.total += total_size
+    on_progress = functools.partial(_track_progress, progress,
+                                    total_size is not None)
+    future = s3t.upload(source, bucket, target_path,
                         extra_args={'ServerSideEncryption': 'AES256',
                                     'StorageClass': storage_class.name},
                         subscribers=[
-                            s3transfer.ProgressCallbackInvoker(
-                                progress.update)])
+                            s3transfer.ProgressCallbackInvoker(on_progress)])
     try:
         future.result()
     except ClientError as e:
-        logger.error(f'Upload failed for {source_path} to {target_path}', e)
+        logger.error(f'Upload failed for {target_path}', e)
+        return False
+
+    return True
+
+
+def _copy(bucket: str, source_path: str, target_path: str,
+          storage_class: StorageClass) -> bool:
+    logger.debug(f'Copying {source_path} to {target_path}...')
+    try:
+        _s3_client().copy({'Bucket': bucket, 'Key': source_path},
+                          bucket, target_path,
+                          ExtraArgs={'ServerSideEncryption': 'AES256',
+                                     'StorageClass': storage_class.name})
+    except ClientError as e:
+        logger.error(f'Copy failed for {target_path}: {e}')
         return False
-    finally:
-        s3t.shutdown()
-        progress.close()
 
     return True
 
 
+def _track_progress(progress: tqdm.tqdm, known_size: bool,
+                    bytes_transferred: int) -> None:
+    with progress.get_lock():
+        if not known_size:
+            progress.total += bytes_transferred
+        progress.update(bytes_transferred)
+
+
+def _lock_row(entry: FreezerLockEntry) -> List[Any]:
+    return [entry.target_path, entry.source_path,
+            entry.storage_class.name, entry.status.value,
+            'force' if entry.force else '',
+            '' if entry.size is None else entry.size,
+            '' if entry.mtime_ns is None else entry.mtime_ns]
+
+
+def _serialize_lock(entries: List[FreezerLockEntry]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=',')
+    writer.writerows(_lock_row(entry) for entry in entries)
+    return buffer.getvalue()
+
+
 def _dump_lock(path: str, entries: List[FreezerLockEntry]) -> None:
-    with open(path, 'w') as lock_file:
-        writer = csv.writer(lock_file, delimiter=',')
-        for entry in entries:
-            writer.writerow(
-                [entry.target_path, entry.source_path,
-                 entry.storage_class.name, entry.status.value,
-                 'force' if entry.force else ''])
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as lock_file:
+        lock_file.write(_serialize_lock(entries))
+        lock_file.flush()
+        os.fsync(lock_file.fileno())
+    os.replace(tmp_path, path)
+    # The rename itself is only durable once the directory is synced
+    dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _commit_lock(path: str, entries: List[FreezerLockEntry]) -> None:
+    _dump_lock(path, entries)
+    # Everything journaled is in the lock now
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(f'{path}.wal')
+
+
+class _LockBackup:
+    """Keeps a copy of the lock in S3 from a background thread.
+
+    Changes are coalesced: each upload sends the newest state of the entries,
+    and one last upload happens on exit.
+    """
+
+    def __init__(self, bucket: str, key: str,
+                 entries: List[FreezerLockEntry]) -> None:
+        self._bucket = bucket
+        self._key = key
+        self._entries = entries
+        self._dirty = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> _LockBackup:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self._closed = True
+        self._dirty.set()
+        self._thread.join()
+
+    def mark_dirty(self) -> None:
+        self._dirty.set()
+
+    def _run(self) -> None:
+        closed = False
+        while not closed:
+            self._dirty.wait()
+            self._dirty.clear()
+            closed = self._closed
+            _backup_lock(self._bucket, self._key,
+                         _serialize_lock(self._entries))
+
+
+def _backup_lock(bucket: str, key: str, body: str) -> None:
+    try:
+        _s3_client().put_object(Bucket=bucket, Key=key, Body=body.encode(),
+                                ServerSideEncryption='AES256',
+                                StorageClass=StorageClass.STANDARD.name)
+    except (BotoCoreError, ClientError) as e:
+        logger.warning(f'Lock backup failed for {key}: {e}')
 
 
 def main() -> int:
@@ -11,6 +11,11 @@ def get_logger(name: str, level: Union[int, str, Optional[int]] = None,
     level = level if level else LOG_LEVEL
     the_logger = logging.getLogger(name)
     the_logger.setLevel(level)
+    if the_logger.handlers:
+        for existing_handler in the_logger.handlers:
+            existing_handler.setLevel(level)
+        return the_logger
+    the_logger.propagate = False
     handler = logging.StreamHandler()
     handler.setLevel(level)
     log_format = '%(levelname)s: %(message)s' if prefix else '%(message)s'